@@ -1,9 +1,11 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 
 class ChatRequest(BaseModel):
     """
     This is the data we expect from the frontend.
     """
+    model_config = ConfigDict(defer_build=True)
+
     query: str
     llm_choice: str  # e.g., "groq", "openai"
     api_key: str | None = None # Optional API key
@@ -12,6 +14,8 @@ class ChatResponse(BaseModel):
     """
     This is the data we will send back to the frontend.
     """
+    model_config = ConfigDict(defer_build=True)
+
     answer: str
     # We can add sources later if needed
     # sources: list[str]
\ No newline at end of file
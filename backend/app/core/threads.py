@@ -0,0 +1,17 @@
+import os
+
+# Threads each worker process gives to model inference and FAISS search.
+# Defaults to half the cores for a single process; with several uvicorn
+# workers, set INFERENCE_THREADS to about (physical cores / workers).
+INFERENCE_THREADS = int(
+    os.environ.get("INFERENCE_THREADS", max(1, (os.cpu_count() or 2) // 2))
+)
+
+def pin_openmp_env():
+    """
+    Sets OMP_NUM_THREADS / MKL_NUM_THREADS to INFERENCE_THREADS unless they are
+    already set. OpenMP and MKL read these once, when the library is loaded,
+    so this must run before numpy, torch or faiss are imported.
+    """
+    os.environ.setdefault("OMP_NUM_THREADS", str(INFERENCE_THREADS))
+    os.environ.setdefault("MKL_NUM_THREADS", str(INFERENCE_THREADS))
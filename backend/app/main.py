@@ -1,26 +1,71 @@
+# Must run before anything imports numpy, torch or faiss
+from .core.threads import pin_openmp_env
+pin_openmp_env()
+
 import os
-import shutil
-from fastapi import FastAPI, HTTPException, UploadFile, File
+import tempfile
+import threading
+import aiofiles
+from fastapi import FastAPI, HTTPException, Request, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 import uvicorn
 import sys
+from contextlib import asynccontextmanager
 
 # --- Relative Imports ---
-from .api.model import ChatRequest, ChatResponse
+from .api.model import ChatRequest
 
 # --- Our RAG Engine ---
 # We now import the *master function*
-from .services.rag_pipeline import run_rag_pipeline
+from .services.rag_pipeline import run_rag_pipeline_stream, registry, configure_inference_threads
 
 # --- Our Ingestion Function ---
-from .services.ingestion import run_ingestion, CORPUS_PATH
+from .services.ingestion import run_ingestion, get_paths
+
+# --- App Lifespan ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Pre-warms the shared models and indexes once, before the first request.
+    """
+    get_paths()  # Creates the data directories if they are missing
+    configure_inference_threads()
+    print("Warming up model registry...")
+    registry.warm_up()
+    print("Model registry ready.")
+    yield
 
 # Initialize the FastAPI app
 app = FastAPI(
     title="Precision-RAG API",
-    description="API for the Precision-RAG hybrid search and re-ranking system."
+    description="API for the Precision-RAG hybrid search and re-ranking system.",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
+# --- Upload Size Limit ---
+MAX_UPLOAD_BYTES = 100 * 1024 * 1024  # 100 MB
+UPLOAD_CHUNK_BYTES = 1 << 20          # 1 MB
+
+# Registered before CORS so CORS wraps it and the browser can read the error.
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    """
+    Rejects oversized uploads from their Content-Length header before FastAPI
+    reads and spools the multipart body.
+    """
+    if request.url.path == "/upload":
+        content_length = request.headers.get("content-length")
+        if content_length is not None:
+            try:
+                size = int(content_length)
+            except ValueError:
+                return ORJSONResponse(status_code=400, content={"detail": "Invalid Content-Length header."})
+            if size > MAX_UPLOAD_BYTES:
+                return ORJSONResponse(status_code=413, content={"detail": "File is too large."})
+    return await call_next(request)
+
 # --- CORS Configuration ---
 app.add_middleware(
     CORSMiddleware,
@@ -63,54 +108,95 @@ def read_root():
 async def upload_file(file: UploadFile = File(...)):
     """
     Receives a file from the frontend and saves it to the /corpus directory.
+    The file is streamed to a hidden temp file in chunks (so the event loop is
+    never blocked) and only replaces the target once it passed the size check.
     """
-    file_path = os.path.join(CORPUS_PATH, file.filename)
+    corpus_dir = get_paths().corpus
+    file_path = os.path.join(corpus_dir, file.filename)
+    fd, tmp_path = tempfile.mkstemp(dir=corpus_dir, prefix=".upload-", suffix=".part")
+    os.close(fd)
     try:
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        written = 0
+        async with aiofiles.open(tmp_path, "wb") as out:
+            while chunk := await file.read(UPLOAD_CHUNK_BYTES):
+                written += len(chunk)
+                # Content-Length can be missing or wrong, so check what is actually sent
+                if written > MAX_UPLOAD_BYTES:
+                    raise HTTPException(status_code=413, detail="File is too large.")
+                await out.write(chunk)
+
+        os.replace(tmp_path, file_path)
         return {"message": f"File '{file.filename}' uploaded successfully."}
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error uploading file: {e}")
         raise HTTPException(status_code=500, detail=f"Could not save file: {e}")
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 
+# One ingestion at a time per process: builds share the BM25 token cache
+_INGEST_LOCK = threading.Lock()
+
 @app.post("/ingest")
-async def ingest_documents():
+def ingest_documents():
     """
     Runs the ingestion script to re-index all documents in the /corpus folder.
+    A plain def, so FastAPI runs it in its threadpool and the event loop keeps
+    serving /chat from the current indexes while the new build is written.
     """
+    if not _INGEST_LOCK.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="An ingestion is already running. Try again once it has finished.")
     try:
         print("Starting /ingest endpoint...")
         # Run the ingestion function
         run_ingestion()
         
-        print("Ingestion complete. Triggering server reload...")
-        
-        # This forces uvicorn --reload to see a change and restart
-        with open(__file__, "a") as f:
-            f.write(" ")
+        # The next /chat request reloads the fresh indexes from disk
+        registry.invalidate()
+        print("Ingestion complete.")
             
-        return {"message": "Ingestion complete. Server is restarting with new data."}
+        return {"message": "Ingestion complete. The library is now updated."}
 
     except Exception as e:
         print(f"Error during ingestion: {e}")
         raise HTTPException(status_code=500, detail=f"Ingestion failed: {e}")
+    finally:
+        _INGEST_LOCK.release()
 
 
-@app.post("/chat")
-async def chat_endpoint(request: ChatRequest) -> ChatResponse:
+async def _stream_answer(query: str, llm):
     """
-    The main chat endpoint.
+    Wraps the pipeline stream so errors raised after the response has started
+    are still reported to the client.
+    """
+    try:
+        async for chunk in run_rag_pipeline_stream(query, llm):
+            yield chunk
+    except Exception as e:
+        print(f"An error occurred in /chat: {e}")
+        yield f"\n\nError: {e}"
+
+
+@app.post("/chat", response_class=StreamingResponse)
+async def chat_endpoint(request: ChatRequest):
+    """
+    The main chat endpoint. Streams the answer back as it is generated.
     """
     try:
         # 1. Select the LLM
         llm = get_llm(request.llm_choice, request.api_key)
         
-        # 2. Run the full pipeline (this now loads models and releases them)
-        answer = run_rag_pipeline(request.query, llm)
-        
-        return ChatResponse(answer=answer)
-
+        # 2. Stream the full pipeline (models are shared through the registry)
+        return StreamingResponse(
+            _stream_answer(request.query, llm),
+            media_type="text/event-stream"
+        )
+
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"An error occurred in /chat: {e}")
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
@@ -1,55 +1,172 @@
 import os
-import pickle
 import shutil # Import this to delete directories
-from langchain_community.document_loaders import PyPDFLoader, TextLoader
+import multiprocessing
+import hashlib
+import json
+import time
+import uuid
+from dataclasses import dataclass
+from functools import lru_cache
+import bm25s
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import Chroma
+from transformers import AutoTokenizer
 from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_community.retrievers import BM25Retriever
-import sys 
+import torch
+import faiss
+import numpy as np
+
+from .loaders import load_file
 
 # --- 1. Define Paths ---
-try:
+@dataclass(frozen=True)
+class IndexPaths:
+    """
+    Files of one index build. Every ingestion writes a fresh build directory,
+    so the build the API is serving is never modified in place.
+    """
+    root: str
+
+    @property
+    def faiss_index(self):
+        return os.path.join(self.root, "index.faiss")
+
+    @property
+    def docstore(self):
+        return os.path.join(self.root, "docstore.jsonl")
+
+    @property
+    def bm25_index_dir(self):
+        return os.path.join(self.root, "bm25s")
+
+@dataclass(frozen=True)
+class Paths:
+    corpus: str
+    # Holds one directory per index build
+    index_root: str
+    # Names the live build. Replaced atomically once a build is complete; the
+    # API compares it to the build it has loaded to decide when to reload.
+    current_index: str
+    # Shared by all builds so re-ingestion can reuse tokens
+    bm25_token_cache: str
+
+    def index_build(self, build_id) -> IndexPaths:
+        return IndexPaths(os.path.join(self.index_root, build_id))
+
+@lru_cache(maxsize=None)
+def get_paths() -> Paths:
+    """
+    Resolves the data paths and makes sure the directories exist.
+    Called on first use (ingestion or API startup), not at import time.
+    """
     base_dir = os.path.dirname(os.path.abspath(__file__))
     project_root = os.path.abspath(os.path.join(base_dir, "..", "..", ".."))
-    
-    CORPUS_PATH = os.path.join(project_root, "corpus")
-    VECTORSTORE_PATH = os.path.join(project_root, "vectorstore")
-    BM25_INDEX_PATH = os.path.join(project_root, "bm25_index", "bm25_retriever.pkl")
-    
+    index_root = os.path.join(project_root, "indexes")
+
+    paths = Paths(
+        corpus=os.path.join(project_root, "corpus"),
+        index_root=index_root,
+        current_index=os.path.join(index_root, "CURRENT"),
+        bm25_token_cache=os.path.join(index_root, "token_cache.json"),
+    )
+
     # Ensure output directories exist
-    os.makedirs(CORPUS_PATH, exist_ok=True) # Makes sure /corpus exists
-    os.makedirs(VECTORSTORE_PATH, exist_ok=True)
-    os.makedirs(os.path.dirname(BM25_INDEX_PATH), exist_ok=True)
+    try:
+        os.makedirs(paths.corpus, exist_ok=True) # Makes sure /corpus exists
+        os.makedirs(paths.index_root, exist_ok=True)
+    except OSError as e:
+        raise RuntimeError(f"Error setting up paths: {e}") from e
+    return paths
 
-except Exception as e:
-    print(f"Error setting up paths: {e}")
-    sys.exit(1)
+def read_current_build():
+    """
+    Returns the id of the live index build, or None if none was published yet.
+    """
+    try:
+        with open(get_paths().current_index, "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
 
 
-# --- 2. NEW: Function to clear old indexes ---
-def clear_indexes():
+# --- 1b. Embedding Device Selection ---
+def _pick_device():
     """
-    Deletes the old vectorstore and BM25 index to start fresh.
+    Returns the fastest available device for the embedding model.
     """
-    print("Clearing old indexes...")
-    if os.path.exists(VECTORSTORE_PATH):
-        shutil.rmtree(VECTORSTORE_PATH)
-        print(f"Removed old vectorstore at {VECTORSTORE_PATH}")
-    
-    if os.path.exists(BM25_INDEX_PATH):
-        os.remove(BM25_INDEX_PATH)
-        print(f"Removed old BM25 index at {BM25_INDEX_PATH}")
-        
-    # Re-create the directories
-    os.makedirs(VECTORSTORE_PATH, exist_ok=True)
-    os.makedirs(os.path.dirname(BM25_INDEX_PATH), exist_ok=True)
+    if torch.cuda.is_available():
+        return 'cuda'
+    if torch.backends.mps.is_available():
+        return 'mps'
+    return 'cpu'
+
+class _FastEmbeddings(HuggingFaceEmbeddings):
+    """
+    HuggingFaceEmbeddings that runs in FP16 on CUDA and retries with a
+    smaller batch size if the GPU runs out of memory.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        if self.model_kwargs.get('device') == 'cuda':
+            self.client.half()
+
+    def embed_documents(self, texts):
+        try:
+            return super().embed_documents(texts)
+        except torch.cuda.OutOfMemoryError:
+            print("GPU out of memory while embedding. Retrying with batch_size=32...")
+            torch.cuda.empty_cache()
+            self.encode_kwargs = {**self.encode_kwargs, 'batch_size': 32}
+            return super().embed_documents(texts)
+
+
+# --- 2. Index Builds (publish + clean up) ---
+STAGING_PREFIX = ".building-"
+STALE_STAGING_SECONDS = 24 * 60 * 60
+
+def _new_build_id():
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+def _publish_build(build_id):
+    """
+    Points CURRENT at a finished build. The pointer is written to a temp file
+    and swapped in with os.replace, so readers see either the old or the new
+    build id, never a partial one.
+    """
+    paths = get_paths()
+    tmp_path = f"{paths.current_index}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(build_id)
+    os.replace(tmp_path, paths.current_index)
+    print(f"Published index build {build_id}.")
+
+def _prune_old_builds(keep):
+    """
+    Deletes finished builds not listed in `keep`, plus staging directories
+    left behind by crashed ingestions. The previous build is kept by the
+    caller, since other workers may still be serving it.
+    """
+    index_root = get_paths().index_root
+    for name in os.listdir(index_root):
+        path = os.path.join(index_root, name)
+        if not os.path.isdir(path) or name in keep:
+            continue
+        if name.startswith(STAGING_PREFIX):
+            # Another ingestion may still be writing here
+            if time.time() - os.path.getmtime(path) < STALE_STAGING_SECONDS:
+                continue
+        print(f"Removing old index build at {path}")
+        shutil.rmtree(path, ignore_errors=True)
 
 
 # --- 3. Simplified Document Loader (PDF and TXT only) ---
+def _ingest_workers():
+    default_workers = max(1, (os.cpu_count() or 1) - 1)
+    return int(os.environ.get("INGEST_WORKERS", default_workers))
+
 def load_documents(corpus_path):
     """
     Loads all .pdf and .txt documents from the corpus directory.
+    Files are parsed in parallel with a process pool (size set by INGEST_WORKERS).
     """
     print(f"Loading documents from: {corpus_path}")
     all_documents = []
@@ -58,70 +175,135 @@ def load_documents(corpus_path):
         print(f"Error: Corpus directory not found at {corpus_path}")
         return []
 
+    file_paths = []
     for root, dirs, files in os.walk(corpus_path):
         for file in files:
             # Skip hidden files
             if file.startswith('.'):
                 continue
-                
-            file_path = os.path.join(root, file)
-            
-            try:
-                if file.endswith(".pdf"):
-                    print(f"Loading PDF: {file}")
-                    loader = PyPDFLoader(file_path)
-                    all_documents.extend(loader.load())
-                
-                elif file.endswith(".txt"):
-                    print(f"Loading TEXT: {file}")
-                    loader = TextLoader(file_path, encoding='utf-8')
-                    all_documents.extend(loader.load())
-                
-                else:
-                    pass
-            except Exception as e:
-                print(f"Failed to load {file}. Error: {e}")
-                pass 
+            if file.endswith((".pdf", ".txt")):
+                file_paths.append(os.path.join(root, file))
+
+    if not file_paths:
+        print("Loaded 0 documents in total.")
+        return []
+
+    workers = min(_ingest_workers(), len(file_paths))
+    print(f"Loading {len(file_paths)} files with {workers} worker(s)...")
+    # This runs inside the API process, which already has torch, ONNX Runtime
+    # and several threads going; fork() from such a process can deadlock.
+    # "spawn" starts clean workers that only import the light loaders module.
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(workers) as pool:
+        for docs in pool.imap_unordered(load_file, file_paths, chunksize=4):
+            all_documents.extend(docs)
 
     print(f"Loaded {len(all_documents)} documents in total.")
     return all_documents
 
 # --- 4. Split Documents ---
+EMBEDDING_MAX_SEQ_LENGTH = 256  # all-MiniLM-L6-v2's max_seq_length
+# tokenizer.tokenize() does not count the [CLS] and [SEP] tokens the model adds
+CHUNK_SIZE_TOKENS = EMBEDDING_MAX_SEQ_LENGTH - 2
+
 def split_documents(documents):
+    """
+    Splits documents into chunks measured in tokens of the embedding model.
+    The fast (Rust) tokenizer keeps length checks in native code, and chunks
+    plus the special tokens fit the model's 256-token window, so nothing is
+    truncated at embed time.
+    """
     print("Splitting documents into chunks...")
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200,
-        length_function=len,
+    tokenizer = AutoTokenizer.from_pretrained("sentence-transformers/all-MiniLM-L6-v2")
+    text_splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+        tokenizer,
+        chunk_size=CHUNK_SIZE_TOKENS,
+        chunk_overlap=32,
     )
     chunks = text_splitter.split_documents(documents)
     print(f"Split documents into {len(chunks)} chunks.")
     return chunks
 
-# --- 5. Create Vectorstore (ChromaDB) ---
-def create_vectorstore(chunks, embedding_model):
-    print(f"Creating vectorstore at: {VECTORSTORE_PATH}")
-    vectorstore = Chroma.from_documents(
-        documents=chunks,
-        embedding=embedding_model, 
-        persist_directory=VECTORSTORE_PATH
-    )
+# --- 5. Create Vectorstore (FAISS HNSW, int8) ---
+FAISS_HNSW_M = 32
+FAISS_EF_CONSTRUCTION = 200
+
+def create_vectorstore(chunks, embedding_model, index_paths):
+    """
+    Embeds all chunks in one call and builds a FAISS HNSW index whose vectors
+    are stored as 8-bit scalar-quantized codes (4x smaller than FP32).
+    Vector i belongs to line i of the JSONL docstore saved next to it,
+    which holds the chunk text and metadata.
+    """
+    print(f"Creating vectorstore at: {index_paths.root}")
+    texts = [chunk.page_content for chunk in chunks]
+    print(f"Embedding {len(texts)} chunks...")
+    vectors = np.asarray(embedding_model.embed_documents(texts), dtype="float32")
+
+    index = faiss.IndexHNSWSQ(vectors.shape[1], faiss.ScalarQuantizer.QT_8bit, FAISS_HNSW_M)
+    index.hnsw.efConstruction = FAISS_EF_CONSTRUCTION
+    # The quantizer learns per-dimension value ranges from the corpus
+    index.train(vectors)
+    index.add(vectors)
+    faiss.write_index(index, index_paths.faiss_index)
+
+    with open(index_paths.docstore, "w", encoding="utf-8") as f:
+        for chunk in chunks:
+            f.write(json.dumps({"text": chunk.page_content, "metadata": chunk.metadata}) + "\n")
     print("Vectorstore created successfully.")
-    return vectorstore
+    return index
+
+# --- 6. Create BM25 Index (BM25S) ---
+def _tokenize_with_cache(chunk_texts):
+    """
+    Tokenizes chunk texts for BM25, reusing the tokens of any chunk whose
+    content (sha1) was already seen in a previous ingestion.
+    """
+    cache_path = get_paths().bm25_token_cache
+    cache = {}
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable BM25 token cache: {e}")
+
+    hashes = [hashlib.sha1(text.encode("utf-8")).hexdigest() for text in chunk_texts]
+    missing = {h: text for h, text in zip(hashes, chunk_texts) if h not in cache}
+    if missing:
+        new_tokens = bm25s.tokenize(
+            list(missing.values()), stopwords="en", return_ids=False, show_progress=False
+        )
+        cache.update(zip(missing.keys(), new_tokens))
+    print(f"Tokenized {len(missing)} new chunks, reused {len(hashes) - len(missing)} from cache.")
+
+    # Write back only the chunks that are still in the corpus. The temp file +
+    # os.replace keeps the cache whole if another worker is ingesting too.
+    tmp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({h: cache[h] for h in set(hashes)}, f)
+    os.replace(tmp_path, cache_path)
+
+    return [cache[h] for h in hashes]
 
-# --- 6. Create BM25 Index ---
-def create_bm25_index(chunks):
+
+def create_bm25_index(chunks, index_paths):
+    """
+    Builds a BM25S sparse index and saves it with its corpus (text + metadata).
+    The score matrix is stored as .npy arrays that the API memory-maps on load.
+    """
     print("Creating BM25 index...")
     try:
         chunk_texts = [doc.page_content for doc in chunks]
-        chunk_metadatas = [doc.metadata for doc in chunks]
-        bm25_retriever = BM25Retriever.from_texts(
-            texts=chunk_texts,
-            metadatas=chunk_metadatas
-        )
-        print(f"Saving BM25 index to: {BM25_INDEX_PATH}")
-        with open(BM25_INDEX_PATH, 'wb') as f:
-            pickle.dump(bm25_retriever, f)
+        corpus = [
+            {"text": doc.page_content, "metadata": doc.metadata}
+            for doc in chunks
+        ]
+        bm25_retriever = bm25s.BM25()
+        bm25_retriever.index(_tokenize_with_cache(chunk_texts))
+        index_dir = index_paths.bm25_index_dir
+        print(f"Saving BM25 index to: {index_dir}")
+        bm25_retriever.save(index_dir, corpus=corpus)
         print("BM25 index created and saved successfully.")
         return bm25_retriever
     except Exception as e:
@@ -132,46 +314,62 @@ def create_bm25_index(chunks):
 def run_ingestion():
     """
     Main function to run the complete ingestion pipeline.
-    This is what our API will call.
+    This is what our API will call. Raises RuntimeError if no new build was
+    published, in which case the current indexes stay live.
     """
     print("--- Starting Ingestion Pipeline ---")
+    paths = get_paths()
     
-    # 1. NEW: Clear old indexes first
-    clear_indexes()
-    
-    # 2. Load
-    documents = load_documents(CORPUS_PATH)
+    # 1. Load
+    documents = load_documents(paths.corpus)
     if not documents:
-        print("No .pdf or .txt documents found in /corpus. Exiting.")
-        return
+        raise RuntimeError("No .pdf or .txt documents found in /corpus.")
 
-    # 3. Split
+    # 2. Split
     chunks = split_documents(documents)
     if not chunks:
-        print("No chunks were created. Exiting.")
-        return
+        raise RuntimeError("No chunks were created from the documents in /corpus.")
         
-    # 4. Initialize Embedding Model (ONCE)
+    # 3. Initialize Embedding Model (ONCE)
     print("Initializing embedding model (all-MiniLM-L6-v2)...")
     try:
         model_name = "all-MiniLM-L6-v2"
-        embeddings = HuggingFaceEmbeddings(
+        device = _pick_device()
+        embeddings = _FastEmbeddings(
             model_name=model_name,
-            model_kwargs={'device': 'cpu'}
+            model_kwargs={'device': device},
+            encode_kwargs={
+                'batch_size': 128,
+                'normalize_embeddings': True,
+                'convert_to_numpy': True
+            }
         )
-        print("Embedding model initialized.")
+        print(f"Embedding model initialized on {device}.")
     except Exception as e:
-        print(f"Error initializing embedding model: {e}")
-        return
+        raise RuntimeError(f"Error initializing embedding model: {e}") from e
 
-    # 5. Create and persist Chroma vectorstore
-    create_vectorstore(chunks, embeddings)
-    
-    # 6. Create and save BM25 index
-    create_bm25_index(chunks)
+    # 4. Build both indexes into a staging directory that no reader uses
+    build_id = _new_build_id()
+    staging_paths = paths.index_build(STAGING_PREFIX + build_id)
+    os.makedirs(staging_paths.root)
+    try:
+        create_vectorstore(chunks, embeddings, staging_paths)
+        if create_bm25_index(chunks, staging_paths) is None:
+            raise RuntimeError("BM25 index could not be created.")
+    except Exception:
+        shutil.rmtree(staging_paths.root, ignore_errors=True)
+        print("Index build failed. Keeping the current indexes.")
+        raise
+
+    # 5. Move the finished build into place and point CURRENT at it
+    previous_build = read_current_build()
+    os.rename(staging_paths.root, paths.index_build(build_id).root)
+    _publish_build(build_id)
+    _prune_old_builds(keep={build_id, previous_build})
     
     print("--- Ingestion Pipeline Finished Successfully ---")
 
-# This part calls the renamed function
+# This part calls the renamed function.
+# Run from the backend/ folder with: python -m app.services.ingestion
 if __name__ == "__main__":
     run_ingestion()
\ No newline at end of file
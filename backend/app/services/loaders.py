@@ -0,0 +1,24 @@
+import os
+from langchain_community.document_loaders import PyPDFLoader, TextLoader
+
+# This module is imported by the ingestion process pool's workers, so it must
+# stay lightweight: no torch, faiss or transformers imports here.
+
+def load_file(file_path):
+    """
+    Loads a single .pdf or .txt file into LangChain Documents.
+    Returns an empty list (and logs) if the file cannot be parsed.
+    """
+    file = os.path.basename(file_path)
+    try:
+        if file.endswith(".pdf"):
+            print(f"Loading PDF: {file}")
+            return PyPDFLoader(file_path).load()
+
+        elif file.endswith(".txt"):
+            print(f"Loading TEXT: {file}")
+            return TextLoader(file_path, encoding='utf-8').load()
+
+    except Exception as e:
+        print(f"Failed to load {file}. Error: {e}")
+    return []
@@ -1,5 +1,8 @@
 import os
-import pickle
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 
 # --- 0. LOAD ENVIRONMENT VARIABLES FIRST ---
 from dotenv import load_dotenv
@@ -8,36 +11,140 @@ project_root_for_env = os.path.abspath(os.path.join(base_dir_for_env, "..", ".."
 load_dotenv(dotenv_path=os.path.join(project_root_for_env, "backend", ".env"))
 # --- End of new code ---
 
-from langchain_community.vectorstores import Chroma
 from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_community.retrievers import BM25Retriever
+from langchain_core.documents import Document
 from langchain_core.prompts import PromptTemplate
 from langchain_core.runnables import RunnablePassthrough, RunnableLambda
 from langchain_core.output_parsers import StrOutputParser
-from sentence_transformers import CrossEncoder 
+from transformers import AutoTokenizer
+import onnxruntime as ort
+import numpy as np
+import torch
+import faiss
+import bm25s
+import xxhash
 
-# --- 1. Define Paths (These are still needed) ---
+# Index paths are shared with the ingestion side through get_paths()
+from .ingestion import get_paths, read_current_build
+from ..core.threads import INFERENCE_THREADS
+
+# --- 1. Define Paths ---
 base_dir = os.path.dirname(os.path.abspath(__file__))
 project_root = os.path.abspath(os.path.join(base_dir, "..", "..", ".."))
 
-VECTORSTORE_PATH = os.path.join(project_root, "vectorstore")
-BM25_INDEX_PATH = os.path.join(project_root, "bm25_index", "bm25_retriever.pkl") 
+CROSS_ENCODER_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+ONNX_CROSS_ENCODER_DIR = os.path.join(project_root, "onnx_models", "ms-marco-MiniLM-L-6-v2-int8")
+
+# --- Retrieval Settings ---
+DENSE_K = 8     # FAISS results per query
+FAISS_EF_SEARCH = 64
+SPARSE_K = 15   # BM25 results per query (sparse recall is cheap)
+RRF_K = 60      # Standard Reciprocal Rank Fusion constant
+FUSED_TOP_K = 10
+CONTEXT_K = 3   # Documents passed to the LLM
+# The cross-encoder is skipped only when the retrievers agree on the whole
+# context: the fused #1 is rank 1 in both lists and each of the CONTEXT_K
+# fused documents was returned by both. An RRF score margin cannot express
+# this. With RRF_K=60, any chunk found by both lists (even at dense rank 8 and
+# sparse rank 15, score >= 0.0280) outscores every single-list chunk
+# (<= 1/61 = 0.0164). A margin threshold would therefore fire whenever exactly
+# one chunk overlaps, whatever its ranks.
+
+# Dense and sparse retrieval are independent, so they run side by side.
+_RETRIEVAL_EXECUTOR = ThreadPoolExecutor(max_workers=2)
 
 # --- 2. Helper Functions ---
 # We make them "private" (with _) as they will only be called by our master function.
-def _hybrid_search(query, chroma_retriever, bm25_retriever):
+def _bm25_search(query, bm25_retriever, k=5):
+    """
+    Runs a BM25S query and wraps the hits into LangChain Documents.
+    BM25S always returns k results, so hits that share no term with the
+    query (score 0) are dropped.
+    """
+    k = min(k, bm25_retriever.scores["num_docs"])
+    if k == 0:
+        return []
+    query_tokens = bm25s.tokenize(query, stopwords="en", show_progress=False)
+    results, scores = bm25_retriever.retrieve(query_tokens, k=k, show_progress=False)
+    return [
+        Document(page_content=hit["text"], metadata=hit["metadata"])
+        for hit, score in zip(results[0], scores[0]) if score > 0
+    ]
+
+class _FaissVectorStore:
+    """
+    Minimal read-only vector store: a FAISS index plus the JSONL docstore
+    that maps each vector id to its chunk text and metadata.
+    """
+    def __init__(self, index_path, docstore_path):
+        self.index = faiss.read_index(index_path)
+        self.index.hnsw.efSearch = FAISS_EF_SEARCH
+        with open(docstore_path, "r", encoding="utf-8") as f:
+            self.docstore = [json.loads(line) for line in f]
+
+    def search(self, query_vector, k):
+        k = min(k, self.index.ntotal)
+        if k == 0:
+            return []
+        _, ids = self.index.search(np.asarray([query_vector], dtype="float32"), k)
+        return [
+            Document(page_content=self.docstore[i]["text"], metadata=self.docstore[i]["metadata"])
+            for i in ids[0] if i != -1
+        ]
+
+def _dense_search(query, vectorstore, embeddings, k=5):
+    """
+    Embeds the query once and searches the FAISS index with the vector.
+    """
+    with torch.inference_mode():
+        query_vector = embeddings.embed_query(query)
+    return vectorstore.search(query_vector, k)
+
+def _doc_key(doc):
+    """
+    Dedup key for a chunk: an xxh3 hash of its text. Identical chunks (e.g. the
+    same file uploaded twice, or repeated boilerplate pages) share one key, so
+    RRF merges their ranks and only one copy reaches the reranker.
+    """
+    return xxhash.xxh3_64_intdigest(doc.page_content.encode())
+
+def _hybrid_search(query, vectorstore, bm25_retriever, embeddings):
+    """
+    Fuses dense and sparse results with Reciprocal Rank Fusion.
+    Returns the fused documents (best first) and whether both retrievers
+    agree on the top of the list (see CONTEXT_K above).
+    """
     print(f"Performing hybrid search for: '{query}'")
-    chroma_docs = chroma_retriever.invoke(query)
-    bm25_docs = bm25_retriever.invoke(query)
+    dense_future = _RETRIEVAL_EXECUTOR.submit(_dense_search, query, vectorstore, embeddings, DENSE_K)
+    bm25_future = _RETRIEVAL_EXECUTOR.submit(_bm25_search, query, bm25_retriever, SPARSE_K)
+    dense_docs = dense_future.result()
+    bm25_docs = bm25_future.result()
     
-    all_docs = chroma_docs + bm25_docs
     unique_docs = {}
-    for doc in all_docs:
-        unique_docs[doc.page_content] = doc
-        
-    unique_list = list(unique_docs.values())
-    print(f"Found {len(unique_list)} unique documents after hybrid search.")
-    return unique_list
+    rrf_scores = {}
+    ranks = {}  # key -> [dense rank, sparse rank]; None if not returned
+    for list_idx, ranked_docs in enumerate((dense_docs, bm25_docs)):
+        for rank, doc in enumerate(ranked_docs, start=1):
+            key = _doc_key(doc)
+            doc_ranks = ranks.setdefault(key, [None, None])
+            if doc_ranks[list_idx] is not None:
+                continue  # A copy of this text already ranked higher in this list
+            doc_ranks[list_idx] = rank
+            unique_docs.setdefault(key, doc)
+            rrf_scores[key] = rrf_scores.get(key, 0.0) + 1.0 / (RRF_K + rank)
+
+    ranked_keys = sorted(rrf_scores, key=rrf_scores.get, reverse=True)[:FUSED_TOP_K]
+    fused_docs = [unique_docs[key] for key in ranked_keys]
+
+    context_keys = ranked_keys[:CONTEXT_K]
+    retrievers_agree = (
+        len(context_keys) == CONTEXT_K
+        and ranks[context_keys[0]] == [1, 1]
+        and all(None not in ranks[key] for key in context_keys)
+    )
+
+    print(f"Found {len(unique_docs)} unique documents after hybrid search (retrievers agree: {retrievers_agree}).")
+    return fused_docs, retrievers_agree
 
 def _rerank_documents(query_and_docs: dict, cross_encoder_model):
     query = query_and_docs["query"]
@@ -48,13 +155,72 @@ def _rerank_documents(query_and_docs: dict, cross_encoder_model):
         
     pairs = [[query, doc.page_content] for doc in documents]
     print(f"Reranking {len(pairs)} documents...")
-    scores = cross_encoder_model.predict(pairs)
+    # All pairs are scored in a single ONNX Runtime call
+    scores = np.asarray(cross_encoder_model.predict(pairs), dtype=np.float32)
     
-    scored_docs = list(zip(scores, documents))
-    scored_docs.sort(key=lambda x: x[0], reverse=True)
+    if len(scores) <= CONTEXT_K:
+        top_idx = np.argsort(-scores)
+    else:
+        top = np.argpartition(-scores, CONTEXT_K)[:CONTEXT_K]
+        top_idx = top[np.argsort(-scores[top])]
     
-    print(f"Returning top 3 reranked documents.")
-    return [doc for score, doc in scored_docs[:3]]
+    print(f"Returning top {CONTEXT_K} reranked documents.")
+    return [documents[i] for i in top_idx]
+
+def _export_quantized_cross_encoder(save_dir):
+    """
+    Exports the cross-encoder to ONNX and applies dynamic int8 quantization.
+    This only runs once; later startups load the saved model from save_dir.
+    """
+    from optimum.onnxruntime import ORTModelForSequenceClassification, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+    print(f"Exporting {CROSS_ENCODER_MODEL} to int8 ONNX at: {save_dir}")
+    model = ORTModelForSequenceClassification.from_pretrained(CROSS_ENCODER_MODEL, export=True)
+    model.save_pretrained(save_dir)
+    AutoTokenizer.from_pretrained(CROSS_ENCODER_MODEL).save_pretrained(save_dir)
+
+    quantizer = ORTQuantizer.from_pretrained(save_dir)
+    qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    quantizer.quantize(save_dir=save_dir, quantization_config=qconfig)
+    print("Cross-encoder exported and quantized.")
+
+class _OnnxCrossEncoder:
+    """
+    Drop-in replacement for sentence_transformers.CrossEncoder.predict,
+    backed by an int8-quantized ONNX Runtime session.
+    """
+    def __init__(self, model_dir):
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = INFERENCE_THREADS
+        options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(
+            os.path.join(model_dir, "model_quantized.onnx"),
+            sess_options=options,
+            providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def predict(self, pairs):
+        queries = [query for query, _ in pairs]
+        passages = [passage for _, passage in pairs]
+        features = self.tokenizer(
+            queries, passages,
+            padding="longest", truncation=True, return_tensors="np"
+        )
+        inputs = {
+            name: value.astype(np.int64)
+            for name, value in features.items() if name in self.input_names
+        }
+        logits = self.session.run(None, inputs)[0]
+
+        # ms-marco cross-encoders have a single relevance logit; softmax only
+        # makes sense for multi-class heads.
+        if logits.shape[1] == 1:
+            return logits[:, 0]
+        exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+        return (exp / exp.sum(axis=1, keepdims=True))[:, 1]
 
 def _format_docs(docs):
     return "\n\n".join(doc.page_content for doc in docs)
@@ -76,76 +242,206 @@ Answer:
 """
 RAG_PROMPT = PromptTemplate.from_template(template)
 
-# --- 4. NEW: The "Master" RAG Function ---
-def run_rag_pipeline(query: str, llm):
+# --- 4. Shared Model Registry ---
+@dataclass
+class _ModelRegistry:
     """
-    Loads all models, builds the chain, runs it, and returns the answer.
-    All file locks are released when this function exits.
+    Holds the models and indexes shared by every request.
+    Each one is loaded lazily on first access and then reused, so a /chat call
+    only pays for retrieval and re-ranking, not for loading models from disk.
     """
-    print("--- RAG Pipeline Started (Loading models)... ---")
+    _embeddings: HuggingFaceEmbeddings | None = None
+    _cross_encoder: _OnnxCrossEncoder | None = None
+    _vectorstore: _FaissVectorStore | None = None
+    _bm25_retriever: bm25s.BM25 | None = None
+    _index_build: str | None = None
+    _chains: dict = field(default_factory=dict)
+    _lock: threading.RLock = field(default_factory=threading.RLock)
 
-    # --- A. Load Models ---
-    print("Loading embedding model (all-MiniLM-L6-v2)...")
-    embeddings = HuggingFaceEmbeddings(
-        model_name="all-MiniLM-L6-v2",
-        model_kwargs={'device': 'cpu'} 
-    )
-    
-    print("Initializing cross-encoder for re-ranking...")
-    cross_encoder = CrossEncoder("cross-encoder/ms-marco-MiniLM-L-6-v2")
-
-    # --- B. Load Indexes from Disk ---
-    print(f"Loading vectorstore from: {VECTORSTORE_PATH}")
-    vectorstore = Chroma(
-        persist_directory=VECTORSTORE_PATH,
-        embedding_function=embeddings
-    )
-    chroma_retriever = vectorstore.as_retriever(search_kwargs={"k": 5})
-    
-    print(f"Loading BM25 index from: {BM25_INDEX_PATH}")
-    with open(BM25_INDEX_PATH, 'rb') as f:
-        bm25_retriever = pickle.load(f)
-    bm25_retriever.k = 5
-    
-    print("Models and indexes loaded.")
+    @property
+    def embeddings(self):
+        with self._lock:
+            if self._embeddings is None:
+                print("Loading embedding model (all-MiniLM-L6-v2)...")
+                self._embeddings = HuggingFaceEmbeddings(
+                    model_name="all-MiniLM-L6-v2",
+                    model_kwargs={'device': 'cpu'},
+                    # Must match the ingestion side, which stores normalized vectors
+                    encode_kwargs={'normalize_embeddings': True}
+                )
+                self._embeddings.client.eval()
+            return self._embeddings
 
-    # --- C. Create the Chain ---
-    
-    # Create lambda functions to pass the loaded retrievers/models
-    hybrid_search_lambda = lambda q: _hybrid_search(q, chroma_retriever, bm25_retriever)
-    rerank_lambda = lambda x: _rerank_documents(x, cross_encoder)
-    
-    chain = (
-        {
-            "documents": RunnableLambda(hybrid_search_lambda), 
-            "query": RunnablePassthrough()
-        }
-        | RunnableLambda(rerank_lambda)
-        | RunnableLambda(_format_docs)
-    )
+    @property
+    def cross_encoder(self):
+        with self._lock:
+            if self._cross_encoder is None:
+                print("Initializing int8 ONNX cross-encoder for re-ranking...")
+                if not os.path.exists(os.path.join(ONNX_CROSS_ENCODER_DIR, "model_quantized.onnx")):
+                    _export_quantized_cross_encoder(ONNX_CROSS_ENCODER_DIR)
+                self._cross_encoder = _OnnxCrossEncoder(ONNX_CROSS_ENCODER_DIR)
+            return self._cross_encoder
+
+    def indexes(self):
+        """
+        Returns (vectorstore, bm25_retriever), both loaded from the latest
+        published index build, so a request never mixes two builds.
+        """
+        with self._lock:
+            self._refresh_if_stale()
+            if self._index_build is None:
+                raise FileNotFoundError("No index has been built yet. Run /ingest first.")
+            index_paths = get_paths().index_build(self._index_build)
+            if self._vectorstore is None:
+                print(f"Loading vectorstore from: {index_paths.root}")
+                self._vectorstore = _FaissVectorStore(index_paths.faiss_index, index_paths.docstore)
+            if self._bm25_retriever is None:
+                print(f"Loading BM25 index from: {index_paths.bm25_index_dir}")
+                # mmap=True opens the score matrix (data/indices/indptr .npy
+                # files) with np.load(mmap_mode="r") and reads the corpus
+                # lazily, so every worker process maps the same page-cache
+                # pages instead of holding its own copy of the index.
+                self._bm25_retriever = bm25s.BM25.load(
+                    index_paths.bm25_index_dir, mmap=True, load_corpus=True
+                )
+            return self._vectorstore, self._bm25_retriever
+
+    def get_chain(self, llm_id):
+        """
+        Returns the RAG chain for an (llm_provider, model_name) pair, built once.
+        The chain only closes over the registry, never per-request objects; the
+        LLM itself is passed per call with
+        chain.with_config(configurable={"llm": llm}).
+        """
+        with self._lock:
+            if llm_id not in self._chains:
+                print(f"Building RAG chain for {llm_id}...")
+                self._chains[llm_id] = (
+                    {"context": RunnableLambda(_retrieve_context), "question": RunnablePassthrough()}
+                    | RAG_PROMPT
+                    | RunnableLambda(_configured_llm)
+                    | StrOutputParser()
+                ).with_config(run_name=f"rag_chain[{llm_id[0]}:{llm_id[1]}]")
+            return self._chains[llm_id]
+
+    def warm_up(self):
+        """
+        Loads everything up front (called once at server startup).
+        The indexes are skipped if nothing has been ingested yet.
+        """
+        self.embeddings
+        self.cross_encoder
+        try:
+            self.indexes()
+        except Exception as e:
+            print(f"Indexes not loaded at startup: {e}")
+
+    def invalidate(self):
+        """
+        Drops the loaded indexes so the next request reloads them from the
+        build CURRENT points to. Called after /ingest. The models themselves
+        do not depend on the corpus and are kept.
+        """
+        with self._lock:
+            self._drop_indexes()
+            self._index_build = None
+        print("Model registry invalidated. Indexes will reload on next request.")
+
+    def _refresh_if_stale(self):
+        """
+        Switches to the latest published build if it changed since the indexes
+        were loaded (e.g. one built by another worker). Builds are never
+        modified once published, so while CURRENT is missing or unchanged
+        the loaded indexes stay valid and are kept.
+        """
+        build_id = read_current_build()
+        if build_id is not None and build_id != self._index_build:
+            if self._vectorstore is not None or self._bm25_retriever is not None:
+                print(f"New index build {build_id} published. Reloading...")
+            self._drop_indexes()
+            self._index_build = build_id
+
+    def _drop_indexes(self):
+        self._vectorstore = None
+        self._bm25_retriever = None
+
+
+registry = _ModelRegistry()
+
+def configure_inference_threads():
+    """
+    Pins torch and FAISS to INFERENCE_THREADS with a single torch inter-op
+    thread, so model inference does not oversubscribe the cores uvicorn uses.
+    Call once at startup, before any model runs. The OpenMP/MKL environment
+    variables cannot be set from here, since they are read when torch is
+    imported; main.py sets them with pin_openmp_env() before its imports.
+    """
+    torch.set_num_threads(INFERENCE_THREADS)
+    faiss.omp_set_num_threads(INFERENCE_THREADS)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError as e:
+        # Only allowed before torch has started any parallel work
+        print(f"Could not set torch inter-op threads: {e}")
+    print(f"Inference threads pinned to {INFERENCE_THREADS}.")
 
-    rag_chain = (
-        {"context": chain, "question": RunnablePassthrough()}
-        | RAG_PROMPT
-        | llm
-        | StrOutputParser()
+# --- 5. Retrieval Step (hybrid search + rerank) ---
+def _retrieve_context(query):
+    """
+    Runs hybrid search and re-ranking against the shared registry and returns
+    the formatted context for the prompt. This is the CPU-bound part of a request.
+    """
+    vectorstore, bm25_retriever = registry.indexes()
+    documents, retrievers_agree = _hybrid_search(
+        query, vectorstore, bm25_retriever, registry.embeddings
     )
-    
-    print("RAG chain built. Invoking...")
 
-    # --- D. Run the Chain ---
-    answer = rag_chain.invoke(query)
-    
-    # --- E. Cleanup ---
-    # All local objects (vectorstore, retrievers, models)
-    # go out of scope here. Python's garbage collector will
-    # automatically release all file locks.
-    del vectorstore, chroma_retriever, bm25_retriever, embeddings, cross_encoder
-    print("--- RAG Pipeline Finished. Resources released. ---")
+    if retrievers_agree:
+        print(f"Dense and sparse retrievers agree. Skipping rerank, returning top {CONTEXT_K} fused documents.")
+        top_docs = documents[:CONTEXT_K]
+    else:
+        top_docs = _rerank_documents(
+            {"query": query, "documents": documents}, registry.cross_encoder
+        )
+    return _format_docs(top_docs)
+
+def _configured_llm(prompt, config):
+    # Returning a Runnable makes LangChain run (or stream) it on the prompt
+    return config["configurable"]["llm"]
+
+def _llm_id(llm):
+    return (type(llm).__name__, getattr(llm, "model_name", None))
+
+# --- 6. The "Master" RAG Function ---
+def run_rag_pipeline(query: str, llm):
+    """
+    Runs the prebuilt chain for this LLM and returns the answer.
+    """
+    print("--- RAG Pipeline Started ---")
+
+    rag_chain = registry.get_chain(_llm_id(llm))
+    answer = rag_chain.with_config(configurable={"llm": llm}).invoke(query)
+    print("--- RAG Pipeline Finished. ---")
     
     return answer   
 
+# --- 7. Streaming Version (used by /chat) ---
+async def run_rag_pipeline_stream(query: str, llm):
+    """
+    Same pipeline as run_rag_pipeline, but yields the answer chunk by chunk.
+    LangChain runs the sync retrieval step in a worker thread, so the event
+    loop stays free; the LLM stream is network-bound and is awaited directly.
+    """
+    print("--- RAG Pipeline Started (streaming) ---")
+
+    rag_chain = registry.get_chain(_llm_id(llm))
+    async for chunk in rag_chain.with_config(configurable={"llm": llm}).astream(query):
+        yield chunk
+
+    print("--- RAG Pipeline Finished. ---")
+
 # --- 10. (Optional) Test the pipeline ---
+# Run from the backend/ folder with: python -m app.services.rag_pipeline
 if __name__ == "__main__":
     print("\n--- Testing RAG Pipeline ---")
     
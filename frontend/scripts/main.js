@@ -46,7 +46,7 @@ document.addEventListener("DOMContentLoaded", () => {
             console.log(uploadData.message);
 
             // --- Step 2: Run ingestion ---
-            uploadStatus.textContent = "Step 2/2: Processing file... This may take a moment. The server will restart.";
+            uploadStatus.textContent = "Step 2/2: Processing file... This may take a moment.";
             
             const ingestResponse = await fetch(INGEST_URL, {
                 method: "POST"
@@ -61,7 +61,7 @@ document.addEventListener("DOMContentLoaded", () => {
             console.log(ingestData.message);
 
             // Success!
-            uploadStatus.textContent = `File "${file.name}" processed! Server is restarting. Please wait a moment before chatting.`;
+            uploadStatus.textContent = `File "${file.name}" processed! You can start chatting.`;
             uploadStatus.className = "upload-status success";
             
             // Add a bot message
@@ -99,7 +99,7 @@ document.addEventListener("DOMContentLoaded", () => {
         callChatAPI(query, llmChoice, apiKey);
     });
 
-    // --- 4. Function to call the FastAPI backend (/chat) (NO CHANGE) ---
+    // --- 4. Function to call the FastAPI backend (/chat) ---
     async function callChatAPI(query, llmChoice, apiKey) {
         try {
             const response = await fetch(CHAT_URL, { 
@@ -112,14 +112,32 @@ document.addEventListener("DOMContentLoaded", () => {
                 }),
             });
 
-            removeLoadingMessage();
-
             if (!response.ok) {
+                removeLoadingMessage();
                 const errorData = await response.json();
                 addMessageToChat(`Error: ${errorData.detail || 'Something went wrong'}`, "bot");
             } else {
-                const data = await response.json();
-                addMessageToChat(data.answer, "bot");
+                // The answer is streamed; headers arrive before retrieval is done,
+                // so keep "Thinking..." until the first chunk of text shows up.
+                let answerElement = null;
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                while (true) {
+                    const { done, value } = await reader.read();
+                    if (done) break;
+                    const text = decoder.decode(value, { stream: true });
+                    if (!text) continue;
+                    if (!answerElement) {
+                        removeLoadingMessage();
+                        answerElement = addMessageToChat("", "bot");
+                    }
+                    answerElement.textContent += text;
+                    chatWindow.scrollTop = chatWindow.scrollHeight;
+                }
+                if (!answerElement) {
+                    removeLoadingMessage();
+                    addMessageToChat("No answer was returned.", "bot");
+                }
             }
 
         } catch (error) {
@@ -141,6 +159,7 @@ document.addEventListener("DOMContentLoaded", () => {
         messageElement.appendChild(textElement);
         chatWindow.appendChild(messageElement);
         chatWindow.scrollTop = chatWindow.scrollHeight;
+        return textElement;
     }
 
     // --- 6. Helper function to remove the "Thinking..." message (NO CHANGE) ---